@@ -4,10 +4,13 @@
 # and get all the image links that have been posted in it
 # and put it in a properly labeled file.
 
-from typing import Any, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, FrozenSet, List, Tuple, Union
 import argparse
+import calendar
 import datetime
 import logging
+import mmap
 import sqlite3
 import json
 import glob
@@ -18,33 +21,70 @@ import os
 import re
 
 
+# When updating: Group 1 must be the host name, and group 2 be the specific ID.
+# Nuuls links need the 'i.' subdomain, that is checked in get_links.
+LINK_RE: re.Pattern = re.compile(
+    r"(?:https?://)?(?:i\.)?(imgur\.com|gyazo\.com|nuuls\.com)/([\w\-]+)(?:\.\w*)?"
+)
+# example line '[13:37:00]  quinndt: hello'
+# Groups are hour, minute, second, user and message.
+MESSAGE_RE: re.Pattern = re.compile(
+    r"^\[(\d{2}):(\d{2}):(\d{2})\]\s+([^:]+): (.*)$")
+
+
 class LinkType(enum.Enum):
     Imgur = 'imgur.com'
     Gyazo = 'gyazo.com'
     Nuuls = 'nuuls.com'
 
 
+# Cheap substring search before running LINK_RE, most lines have no links.
+HOST_NEEDLES: Tuple[bytes, ...] = tuple(t.value.encode() for t in LinkType)
+# Host name -> LinkType, a dict lookup is much cheaper than LinkType(host).
+HOST_TYPES: Dict[str, LinkType] = {t.value: t for t in LinkType}
+# The '.png' is needed, only tested on imgur.  And if its a gif
+# or something it will still return the proper data (eg. a gif not png)
+RAW_LINK_TEMPLATES: Dict[LinkType, str] = {
+    LinkType.Imgur: "https://i.imgur.com/{}.png",
+    LinkType.Gyazo: "https://i.gyazo.com/{}.png",
+    LinkType.Nuuls: "https://i.nuuls.com/{}.png",
+}
+# (specific_id, type) pairs that are not images, see filter_and_format_links.
+REJECTED_IDS: FrozenSet[Tuple[str, LinkType]] = frozenset({
+    # List of images "https://imgur.com/a/Some_ID"
+    ("a", LinkType.Imgur),
+    # List of images "https://imgur.com/gallery/Gallery_ID"
+    ("gallery", LinkType.Imgur),
+    ("upload", LinkType.Imgur),
+    # Different sizes "https://i.gyazo.com/thumb/1200/IMAGE_ID-png.jpg"
+    ("thumb", LinkType.Gyazo),
+})
+# Removes newlines from messages.
+NEWLINE_TABLE = str.maketrans('', '', '\r\n')
+
+
 class LinkData:
     """
     Data about a link.
     """
 
+    # No per-instance __dict__, there can be millions of these.
+    __slots__ = ('link', 'user', 'date', 'channel',
+                 'specific_id', 'message', 'type')
+
     def __init__(self,
-                 link: str = None,
-                 link_type: LinkType = None,
-                 specific_id: str = None,
-                 user: str = None,
-                 channel: str = None,
-                 message: str = None,
-                 date: datetime.datetime = None,
+                 link: str,
+                 link_type: LinkType,
+                 specific_id: str,
+                 user: str,
+                 channel: str,
+                 message: str,
+                 date: datetime.datetime,
                  ):
-        """All kwargs are required."""
-        if link == None or user == None or date == None or channel == None or message == None or specific_id == None or link_type == None:
-            raise ValueError(
-                "LinkData.__init__() is missing 1 or more kwargs.")
-        if not isinstance(link_type, LinkType):
-            raise ValueError(
-                "kwarg 'link_type' is not part of the LinkType enum.")
+        """
+        All arguments are required, they are not checked.
+        link_type must be part of the LinkType enum.
+        """
         self.link = link
         self.user = user
         self.date = date
@@ -57,25 +97,23 @@ class LinkData:
         return f"[{self.date}] #{self.channel} {self.user}: {self.raw_link()}"
 
     def raw_link(self) -> str:
-        if self.type == LinkType.Imgur:
-            # The '.png' is needed, only tested on imgur.  And if its a gif
-            # or something it will still return the proper data (eg. a gif not png)
-            return f"https://i.imgur.com/{self.specific_id}.png"
-        elif self.type == LinkType.Gyazo:
-            return f"https://i.gyazo.com/{self.specific_id}.png"
-        elif self.type == LinkType.Nuuls:
-            return f"https://i.nuuls.com/{self.specific_id}.png"
-        raise ValueError("Invalid link type.")
+        return RAW_LINK_TEMPLATES[self.type].format(self.specific_id)
 
     def to_json_serializable(self) -> dict:
         """
         Returns the link data as something that can be JSON serialized.
         """
-        out = self.__dict__
-        out['raw_link'] = self.raw_link()
-        out["type"] = self.type.value
-        out["date"] = self.date.isoformat()
-        return out
+        # A new dict, so the instance itself is never changed.
+        return {
+            'link': self.link,
+            'user': self.user,
+            'date': self.date.isoformat(),
+            'channel': self.channel,
+            'specific_id': self.specific_id,
+            'message': self.message,
+            'type': self.type.value,
+            'raw_link': self.raw_link(),
+        }
 
 
 def get_logfile_info(path: str) -> Tuple[str, datetime.date]:
@@ -83,43 +121,62 @@ def get_logfile_info(path: str) -> Tuple[str, datetime.date]:
     Gets the channel, and date a log file is of.
     """
 
-    findDateRegex: re.Pattern = re.compile(
-        r"^([^-]*)-((\d{4})-(\d{2})-(\d{2}))\.log$")
     # example basename 'quinndt-2021-05-26.log'
+    # The '-YYYY-MM-DD.log' end is fixed width, so it is sliced instead of matched.
     basename = os.path.basename(path)
-    DateMatch = findDateRegex.match(basename)
+    channel = basename[:-15]
+    year, month, day = basename[-14:-10], basename[-9:-7], basename[-6:-4]
 
-    if not DateMatch:
+    if (len(basename) < 15 or not basename.endswith(".log") or "-" in channel
+            or basename[-15] != "-" or basename[-10] != "-" or basename[-7] != "-"
+            or not (year + month + day).isdigit()):
         raise ValueError(
             "Logfile filename does not match patern, cannot extract date.")
 
-    FileDate = datetime.date(
-        *[int(n) for n in [DateMatch.group(3), DateMatch.group(4), DateMatch.group(5)]])
-    return DateMatch.group(1), FileDate
+    FileDate = datetime.date(int(year), int(month), int(day))
+    return channel, FileDate
 
 
 def parse_line(line: str, asumeDate: datetime.date) -> Tuple[str, str, datetime.datetime]:
     """
     Parses the line, getting some metadata.
-    Only works on messages, however the date will always be correct.
+    Only works on messages, raises ValueError for anything else.
 
     Returns the user, message, and date.
     """
-    user, _, message = line[12:].partition(": ")
+    lineMatch = MESSAGE_RE.match(line)
+    if not lineMatch:
+        raise ValueError("Line is not a chat message.")
+
+    hour, mins, second, user, message = lineMatch.groups()
     if not user.isascii():
         # People who have Japanese/Korean/Chinese names
         # The names are in the format "<Special Character Name> <Real Username>"
         # And for some reason (!!!) these names only have one space before them, not 2.
         user = user.split(" ")[1]
 
-    hour, _, rest = line[1:9].partition(":")
-    mins, _, second = rest.partition(":")
-
     messageDate = datetime.datetime(
         asumeDate.year, asumeDate.month, asumeDate.day, int(hour), int(mins), int(second))
     return user, message, messageDate
 
 
+def find_link_lines(text: Union[bytes, mmap.mmap]) -> List[bytes]:
+    """
+    Gets every line in the text that contains one of the image hosts, in order.
+    Scans the whole text once per host instead of checking each line.
+    """
+    # Line start -> line end, so lines with more than one host are only kept once.
+    found: dict = {}
+    for needle in HOST_NEEDLES:
+        idx = text.find(needle)
+        while idx != -1:
+            start = text.rfind(b'\n', 0, idx) + 1
+            end = text.find(b'\n', idx) + 1 or len(text)
+            found[start] = end
+            idx = text.find(needle, end)
+    return [text[start:found[start]] for start in sorted(found)]
+
+
 def get_links(logfile: str) -> List[LinkData]:
     """
     Get all image links present from log file.
@@ -127,45 +184,50 @@ def get_links(logfile: str) -> List[LinkData]:
     links: List[LinkData] = []
     channel, fileDate = get_logfile_info(logfile)
 
-    linkRegex = re.compile(
-        # When updating: Group 3 must be the host name, and group 4 be the specific ID.
-        # If possible move to named capture groups but I couldnt get those to work.
-        r"(https?://)?(i\.)?(imgur\.com|gyazo\.com|(?<=i\.)nuuls\.com)/([\w\-]*)(\.\w*)?"
-    )
-    lines = []
-    with io.open(logfile, "r", encoding='utf-8') as f:
+    # Scanned as bytes straight from the page cache,
+    # only the lines with links in them are copied out and decoded.
+    with io.open(logfile, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be mapped.
+            return links
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            rawLines = find_link_lines(mm)
+    undecodable = 0
+    for rawLine in rawLines:
+        # Comments, things like noting logging start time and timezone.
+        if rawLine.startswith(b'#'):
+            continue
+
         try:
-            lines = f.readlines()
+            line = rawLine.decode('utf-8')
         except UnicodeDecodeError:
-            logging.info(
-                f"Unable to decode file '{os.path.basename(logfile)}'. - Skipping")
-    for line in lines:
-        # Comments, things like noting logging start time and timezone.
-        if line.startswith('#'):
+            undecodable += 1
             continue
 
-        match = linkRegex.finditer(line)
-        for _, match in enumerate(match):
-            fullLink = match.group(0)
-            # Group 3 will be the hostname, and 4 the specific id.
-            linkType = LinkType(match.group(3))
-            imageID = match.group(4)
-            try:
-                user, message, messageDate = parse_line(line, fileDate)
-            except ValueError:
-                # This can happen when the line isnt properly formatted
-                # As chatterino seems to sometimes absolutely FUCK the output lol
-                logging.debug("Unable to parse line: " +
-                              line.replace('\n', ''))
-                continue
+        # Every line here contains a host, so it is parsed once up front
+        # instead of once per link in it.
+        try:
+            user, message, messageDate = parse_line(line, fileDate)
+        except ValueError:
+            # This can happen when the line isnt properly formatted
+            # As chatterino seems to sometimes absolutely FUCK the output lol
+            logging.debug("Unable to parse line: " +
+                          line.replace('\n', ''))
+            continue
 
-            if user.count(" ") != 0:
-                # Very spammy
+        if user.count(" ") != 0:
+            # Very spammy
 
-                # logging.debug(
-                #     "Skipping line because username contains space: " + line.replace('\n', ''))
-                continue
+            # logging.debug(
+            #     "Skipping line because username contains space: " + line.replace('\n', ''))
+            continue
 
+        for match in LINK_RE.finditer(line):
+            # Group 1 will be the hostname, and 2 the specific id.
+            fullLink, host, imageID = match.group(0, 1, 2)
+            linkType = HOST_TYPES[host]
+            if linkType is LinkType.Nuuls and line[match.start(1) - 2:match.start(1)] != "i.":
+                continue
             links.append(LinkData(
                 channel=channel,
                 message=message,
@@ -175,6 +237,9 @@ def get_links(logfile: str) -> List[LinkData]:
                 link_type=linkType,
                 date=messageDate
             ))
+    if undecodable:
+        logging.info(
+            f"Unable to decode {undecodable} line(s) in file '{os.path.basename(logfile)}'. - Skipping them")
     return links
 
 
@@ -189,12 +254,18 @@ def get_all_files(channels: List[str], logs_dir: str) -> List[List[str]]:
 
     for channel in channels:
         files: List[str] = []
-        files_dir = os.path.join(logs_dir, "Twitch", "Channels", channel)
+        # Channels can be globs like 'bar*', only the channel folders are globbed.
+        # Stray files like 'desktop.ini' can match too, only keep folders.
+        files_dirs = [d for d in glob.glob(os.path.join(
+            logs_dir, "Twitch", "Channels", channel)) if os.path.isdir(d)]
 
-        if not os.path.exists(files_dir):
+        if not files_dirs:
             logging.warning(f"Channel '{channel}' does not have logs.")
 
-        files = glob.glob(os.path.join(files_dir, "*"))
+        for files_dir in files_dirs:
+            with os.scandir(files_dir) as entries:
+                files.extend(entry.path for entry in entries
+                             if entry.name.endswith(".log") and entry.is_file())
         all_files.append(files)
     return all_files
 
@@ -206,23 +277,11 @@ def filter_and_format_links(links: List[LinkData]) -> List[LinkData]:
 
     for link in links:
         # Filtering:
-        if link.specific_id == "a" and link.type == LinkType.Imgur:
-            # List of images "https://imgur.com/a/Some_ID"
-            continue
-
-        if link.specific_id == "gallery" and link.type == LinkType.Imgur:
-            # List of images "https://imgur.com/gallery/Gallery_ID"
-            continue
-
-        if link.specific_id == "upload" and link.type == LinkType.Imgur:
-            continue
-
-        if link.specific_id == "thumb" and link.type == LinkType.Gyazo:
-            # Different sizes "https://i.gyazo.com/thumb/1200/IMAGE_ID-png.jpg"
+        if (link.specific_id, link.type) in REJECTED_IDS:
             continue
 
         # Formatting:
-        link.message = link.message.replace('\n', '')
+        link.message = link.message.translate(NEWLINE_TABLE)
 
         newLinks.append(link)
 
@@ -232,10 +291,12 @@ def filter_and_format_links(links: List[LinkData]) -> List[LinkData]:
 def get_all_links(channels: List[LinkData], logs_dir: str) -> List[LinkData]:
     links: List[LinkData] = []
 
-    all_files = get_all_files(channels, logs_dir)
-    for i in range(len(all_files)):
-        for file in all_files[i]:
-            links.extend(get_links(file))
+    all_files = [file for files in get_all_files(channels, logs_dir)
+                 for file in files]
+    # Log files are independent, so they are parsed on all cores.
+    with ProcessPoolExecutor(initializer=setup_logging) as executor:
+        for file_links in executor.map(get_links, all_files, chunksize=8):
+            links.extend(file_links)
 
     return filter_and_format_links(links)
 
@@ -243,6 +304,12 @@ def get_all_links(channels: List[LinkData], logs_dir: str) -> List[LinkData]:
 def save_links_db(links: List[LinkData], args: dict) -> int:
     conn = sqlite3.connect(args['out_file'])
     cur = conn.cursor()
+    # This is a bulk load into an output file that can just be made again,
+    # so trade crash safety for insert speed.
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA journal_mode = MEMORY")
+    cur.execute("PRAGMA temp_store = MEMORY")
+    cur.execute("PRAGMA cache_size = -65536")
     # Create table
     cur.execute(
         """
@@ -252,7 +319,7 @@ def save_links_db(links: List[LinkData], args: dict) -> int:
             `Link` VARCHAR(150) NOT NULL,
             `Link_Type` VARCHAR(50) NOT NULL,
             `Raw_Link` VARCHAR(150) NOT NULL,
-            `Date_Posted` DATETIME NOT NULL,
+            `Date_Posted` INTEGER NOT NULL,
             `User_Posted` VARCHAR(50) NOT NULL,
             `Channel_Posted` VARCHAR(50) NOT NULL,
             `Message_Text` TEXT NOT NULL
@@ -268,13 +335,24 @@ def save_links_db(links: List[LinkData], args: dict) -> int:
             )
         """
     )
+    # Dates are stored as epoch seconds of the time in the log, taken as UTC.
+    # So `datetime(Date_Posted, 'unixepoch')` gives back the time in the log.
+    # Databases from older versions have ISO date strings, convert those the
+    # same way first, or re-running would not replace any of the old rows.
+    cur.execute(
+        """
+        UPDATE OR REPLACE `images`
+        SET `Date_Posted` = CAST(strftime('%s', `Date_Posted`) AS INTEGER)
+        WHERE typeof(`Date_Posted`) = 'text'
+        """
+    )
     # And now insert.
     cursor = cur.executemany(
         """
         INSERT OR REPLACE INTO `images` (
             Specific_ID, Link, Link_Type, Raw_Link, Date_Posted, User_Posted, Channel_Posted, Message_Text
         ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, [(link.specific_id, link.link, link.type.value, link.raw_link(), link.date.isoformat(), link.user, link.channel, link.message.replace('\n', '').replace('\r', '')) for link in links]
+        """, ((link.specific_id, link.link, link.type.value, link.raw_link(), calendar.timegm(link.date.timetuple()), link.user, link.channel, link.message) for link in links)
     )
 
     # Bruh I forgot to do this and I was debugging for like 20 mins
@@ -292,11 +370,26 @@ def save_links_json(links: List[LinkData], args: dict) -> int:
         'total': len(links),
         'created': datetime.datetime.now().isoformat(),
         'channels': args['channels'],
-        'links': [link.to_json_serializable() for link in links]
+        'links': []
     }
 
-    json.dump(output_obj,
-              fp=open(args['out_file'], "w"), **kwargs)
+    # Everything but the links is written by json, the links are then
+    # encoded one at a time so they are never all in memory as dicts.
+    head, _, tail = json.dumps(output_obj, **kwargs).rpartition("[]")
+    # Matches what json.dump would write for the list items.
+    item_sep, item_newline, list_end = ", ", "", "]"
+    if 'indent' in kwargs:
+        item_newline = "\n" + " " * kwargs['indent'] * 2
+        item_sep, list_end = ",", "\n" + " " * kwargs['indent'] + "]"
+
+    with open(args['out_file'], "w") as f:
+        f.write(head + "[")
+        for i, link in enumerate(links):
+            item = json.dumps(link.to_json_serializable(), **kwargs)
+            if i != 0:
+                f.write(item_sep)
+            f.write(item_newline + item.replace("\n", item_newline))
+        f.write((list_end if links else "]") + tail)
 
     return len(links)
 
@@ -396,10 +489,17 @@ def get_arg_parser() -> argparse.ArgumentParser:
     return parser
 
 
-if __name__ == "__main__":
+def setup_logging():
+    """
+    Sets up logging, also used for worker processes.
+    """
     logging.basicConfig(level=logging.INFO,
                         format="%(asctime)s [%(name)s] %(levelname)8s: %(msg)s")
 
+
+if __name__ == "__main__":
+    setup_logging()
+
     parser = get_arg_parser()
     args = parser.parse_args()
     main(args)